@@ -0,0 +1,27 @@
+import os
+import zipfile
+
+# --- Robust Path Configuration ---
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+DATA_DIR = os.path.join(PROJECT_ROOT, "data")
+
+# Quick sanity check of the downloaded static GTFS zips. infolist() walks
+# the central directory once per archive (repeated getinfo() calls rescan
+# it per member), and allowZip64 covers very large stop_times members.
+ZIP_FILES = ["mta_nyc_data.zip", "bart_sf_data.zip"]
+
+for zip_name in ZIP_FILES:
+    full_zip_path = os.path.join(DATA_DIR, zip_name)
+    print(f"\n--- Contents of {zip_name} ---")
+
+    if not os.path.exists(full_zip_path):
+        print(f"Warning: Data file not found at {full_zip_path}. Skipping.")
+        continue
+
+    try:
+        with zipfile.ZipFile(full_zip_path, 'r', allowZip64=True) as z:
+            for info in z.infolist():
+                print(f"{info.filename} ({info.file_size} bytes)")
+    except zipfile.BadZipFile as e:
+        print(f"Error reading {zip_name}: {e}")
@@ -1,5 +1,4 @@
 import sqlite3
-import pandas as pd
 import os
 
 # --- Robust Path Configuration ---
@@ -14,76 +13,94 @@ PERFORMANCE_DB = os.path.join(PROJECT_ROOT, "transit_performance_data.db")
 def analyze_on_time_performance():
     """
     Analyzes real-time trip data to calculate on-time performance metrics
-    and saves the results to the performance database.
+    and saves the results to the performance database. The realtime DB is
+    ATTACHed so the latest-update dedup, both joins, and the aggregation
+    all run inside SQLite instead of materializing full tables in pandas;
+    the static trips/routes tables are never loaded into Python, and only
+    the columns the summary needs leave the database.
     """
-    rt_conn = sqlite3.connect(REALTIME_DB)
     perf_conn = sqlite3.connect(PERFORMANCE_DB)
-
-    print("Reading data from databases...")
-    trips_df = pd.read_sql_query("SELECT * FROM trips", perf_conn)
-    routes_df = pd.read_sql_query("SELECT * FROM routes", perf_conn)
-    rt_updates_query = """
-    SELECT * FROM (
-        SELECT *, ROW_NUMBER() OVER(PARTITION BY trip_id ORDER BY ingestion_timestamp_utc DESC) as rn
-        FROM real_time_trip_updates
-    ) WHERE rn = 1;
+    perf_conn.execute("ATTACH DATABASE ? AS rt", (REALTIME_DB,))
+
+    # The realtime feed uses short agency names; map them to the static
+    # agency_ids inline so the joins line up.
+    performance_query = """
+    WITH latest_updates AS (
+        SELECT r.trip_id,
+               CASE r.agency
+                   WHEN 'MTA' THEN 'MTA_NYC'
+                   WHEN 'BART' THEN 'BART_SF'
+                   ELSE r.agency
+               END AS agency_id,
+               r.arrival_delay_seconds
+        FROM rt.real_time_trip_updates r
+        JOIN (
+            SELECT trip_id, MAX(ingestion_timestamp_utc) AS latest_ingest
+            FROM rt.real_time_trip_updates
+            GROUP BY trip_id
+        ) latest
+          ON r.trip_id = latest.trip_id
+         AND r.ingestion_timestamp_utc = latest.latest_ingest
+    )
+    SELECT t.agency_id,
+           t.route_id,
+           ro.route_short_name,
+           ro.route_long_name,
+           ROUND(AVG(CAST(COALESCE(u.arrival_delay_seconds, 0) AS REAL)) / 60.0, 2) AS average_delay_minutes,
+           COUNT(DISTINCT u.trip_id) AS total_trips
+    FROM latest_updates u
+    JOIN trips t
+      ON t.agency_id = u.agency_id AND t.trip_id = u.trip_id
+    JOIN routes ro
+      ON ro.agency_id = t.agency_id AND ro.route_id = t.route_id
+    GROUP BY t.agency_id, t.route_id, ro.route_short_name, ro.route_long_name;
     """
-    rt_updates_df = pd.read_sql_query(rt_updates_query, rt_conn)
-
-    # Standardize agency_id values to ensure they match
-    agency_mapping = {"MTA": "MTA_NYC", "BART": "BART_SF"}
-    if 'agency' in rt_updates_df.columns:
-        rt_updates_df.rename(columns={'agency': 'agency_id'}, inplace=True)
-        rt_updates_df['agency_id'] = rt_updates_df['agency_id'].replace(agency_mapping)
-
-    print(f"\nFound {len(rt_updates_df)} unique real-time trip updates.")
-    print(f"Found {len(trips_df)} static trips.")
-    
-    if rt_updates_df.empty or trips_df.empty:
-        print("Source data is empty. Cannot perform analysis. Exiting.")
-        return
-
-    print("\nMerging and analyzing...")
-    merged_df = pd.merge(rt_updates_df, trips_df, on=['agency_id', 'trip_id'], how='inner', suffixes=('_rt', '_static'))
-    
-    print(f"\nFound {len(merged_df)} matching trips after merging.")
-    if merged_df.empty:
-        print("No matching trip_ids found between real-time and static data. Cannot continue analysis.")
-        return
-        
-    # --- THE FIX IS HERE ---
-    # After the first merge, the 'route_id' from trips_df is now 'route_id_static'.
-    # We rename it back to 'route_id' so the next merge can find it.
-    if 'route_id_static' in merged_df.columns:
-        merged_df.rename(columns={'route_id_static': 'route_id'}, inplace=True)
-
-    # Now merge with routes to get the route names
-    final_df = pd.merge(merged_df, routes_df, on=['agency_id', 'route_id'], how='inner')
-
-    final_df['arrival_delay_seconds'] = pd.to_numeric(final_df['arrival_delay_seconds']).fillna(0)
-    
-    performance_summary = final_df.groupby(['agency_id', 'route_id', 'route_short_name', 'route_long_name']).agg(
-        average_delay_minutes=('arrival_delay_seconds', lambda x: x.mean() / 60),
-        total_trips=('trip_id', 'nunique')
-    ).reset_index()
 
-    performance_summary['average_delay_minutes'] = performance_summary['average_delay_minutes'].round(2)
+    print("Joining and aggregating inside SQLite...")
+    # The summary is a handful of per-route rows, so plain fetchall avoids
+    # pulling pandas in just to box and re-infer a tiny result set.
+    summary_rows = perf_conn.execute(performance_query).fetchall()
 
-    if performance_summary.empty:
-        print("\nAnalysis resulted in an empty summary. Nothing to save.")
+    if not summary_rows:
+        print("No matching trip_ids found between real-time and static data. Nothing to save.")
+        perf_conn.close()
         return
 
+    row_format = "{:<10} {:<10} {:<18} {:<35} {:>12} {:>12}"
     print("\n--- On-Time Performance Summary ---")
-    print(performance_summary)
+    print(row_format.format("agency_id", "route_id", "short_name", "long_name", "avg_delay_m", "total_trips"))
+    for row in summary_rows:
+        print(row_format.format(*("" if value is None else value for value in row)))
 
     try:
         print("\nSaving analysis results to 'on_time_performance' table...")
-        performance_summary.to_sql('on_time_performance', perf_conn, if_exists='replace', index=False)
+        # Drop the table (and its PK index) first so the insert fills a
+        # plain table, then rebuild the unique index once at the end instead
+        # of maintaining a live B-tree per inserted row.
+        perf_conn.execute("DROP TABLE IF EXISTS on_time_performance")
+        perf_conn.execute("""
+            CREATE TABLE on_time_performance (
+                agency_id TEXT,
+                route_id TEXT,
+                route_short_name TEXT,
+                route_long_name TEXT,
+                average_delay_minutes REAL,
+                total_trips INTEGER
+            )
+        """)
+        perf_conn.executemany(
+            "INSERT INTO on_time_performance VALUES (?, ?, ?, ?, ?, ?)",
+            summary_rows,
+        )
+        perf_conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_otp_agency_route "
+            "ON on_time_performance(agency_id, route_id)"
+        )
+        perf_conn.commit()
         print("Successfully saved performance summary.")
     except Exception as e:
         print(f"Error saving results to database: {e}")
 
-    rt_conn.close()
     perf_conn.close()
     print("\nDatabase connections closed.")
 
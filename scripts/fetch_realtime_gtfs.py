@@ -1,6 +1,11 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.transit import gtfs_realtime_pb2
+from google.protobuf.internal import api_implementation
 import datetime
+import orjson
 import pandas as pd
 import sqlite3
 import os
@@ -9,6 +14,12 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# protobuf >= 4.21 ships the C-backed 'upb' implementation by default; the
+# pure-Python fallback parses large MTA feeds an order of magnitude slower.
+if api_implementation.Type() not in ('cpp', 'upb'):
+    print("Warning: pure-Python protobuf implementation detected. "
+          "Install protobuf>=4.21 for C-accelerated feed parsing.")
+
 # --- Robust Path Configuration ---
 # Get the absolute path of the directory where the script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -38,10 +49,54 @@ SCHEMA_FILE = os.path.join(PROJECT_ROOT, "sql/schema.sql")
 MTA_API_KEY = os.getenv('MTA_API_KEY')
 BART_API_KEY = os.getenv('BART_API_KEY')
 
+# Shared session for all feed fetches: keep-alive connections are reused
+# across same-host (MTA) feeds so the TLS handshake is paid once per host,
+# and transient 5xx responses are retried with backoff.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Column order for real_time_trip_updates inserts. process_trip_updates
+# emits tuples in exactly this order, so the INSERT is prepared once and
+# reused for every row via executemany.
+RT_UPDATE_COLUMNS = (
+    "ingestion_timestamp_utc", "agency", "line_group", "trip_id", "route_id",
+    "direction_id", "current_status", "arrival_delay_seconds",
+    "departure_delay_seconds", "predicted_arrival_time_utc",
+    "predicted_departure_time_utc", "last_update_timestamp_feed",
+)
+# Single-statement ingest: the whole batch is serialized to one JSON array
+# of row-arrays and unpacked by SQLite's json_each/json_extract in C, so
+# Python crosses the sqlite3 boundary once per run instead of once per row
+# or per VALUES batch. OR IGNORE skips duplicate (ingestion_timestamp,
+# agency, trip_id) rows server-side.
+RT_INSERT_JSON_SQL = (
+    f"INSERT OR IGNORE INTO real_time_trip_updates ({', '.join(RT_UPDATE_COLUMNS)}) "
+    "SELECT "
+    + ", ".join(f"json_extract(value, '$[{idx}]')" for idx in range(len(RT_UPDATE_COLUMNS)))
+    + " FROM json_each(?)"
+)
+
 def setup_database(conn):
     """
-    Sets up the database by executing the schema file.
+    Sets up the database by executing the schema file. Skipped when the
+    realtime table and its index already exist, so repeat runs avoid
+    re-reading the file, re-parsing the whole script, and executescript's
+    implicit commit boundary ahead of the insert transaction.
     """
+    present = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master "
+        "WHERE name IN ('real_time_trip_updates', 'idx_trip_ingest', "
+        "'idx_rttu_agency_lg', 'idx_rttu_ingestion')"
+    ).fetchone()[0]
+    if present == 4:
+        return
+
     try:
         with open(SCHEMA_FILE, 'r') as f:
             conn.executescript(f.read())
@@ -52,18 +107,22 @@ def setup_database(conn):
         print(f"Error: Schema file not found at '{SCHEMA_FILE}'. Please ensure the file exists.")
         raise
 
-def fetch_and_parse_gtfs_rt(feed_url, headers=None):
+def fetch_and_parse_gtfs_rt(feed_url, headers=None, session=SESSION):
     """
     Fetches GTFS-RT data from a URL and parses it.
+    Uses the shared pooled SESSION unless another session is passed in.
     Returns a gtfs_realtime_pb2.FeedMessage object or None on error.
     """
     try:
-        response = requests.get(feed_url, headers=headers, timeout=15)
-        response.raise_for_status()
+        # Stream the body and hand the raw bytes straight to the parser,
+        # skipping requests' chunk-join copy of response.content.
+        with session.get(feed_url, headers=headers, timeout=15, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
 
-        feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(response.content)
-        return feed
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.ParseFromString(response.raw.read())
+            return feed
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data from {feed_url}: {e}")
         return None
@@ -71,63 +130,120 @@ def fetch_and_parse_gtfs_rt(feed_url, headers=None):
         print(f"Error parsing Protobuf from {feed_url}: {e}")
         return None
 
+def _isoformat_utc(timestamps):
+    """
+    Converts a list of epoch seconds (ints or None) to ISO-8601 UTC strings
+    in one vectorized pass; None entries stay None.
+    """
+    converted = pd.to_datetime(pd.Series(timestamps, dtype="float64"), unit="s", utc=True)
+    iso = converted.dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    return iso.where(converted.notna(), None).tolist()
+
 def process_trip_updates(feed, agency, line_group_passed=None):
     """
     Processes TripUpdate entities from a GTFS-RT feed.
-    Returns a list of dictionaries with extracted data.
+    Collects raw epoch timestamps in per-column lists and converts them to
+    ISO strings once at the end, instead of building datetime objects per row.
+    Returns a list of tuples ordered as RT_UPDATE_COLUMNS.
     """
-    extracted_data = []
-    ingestion_time = datetime.datetime.now(datetime.timezone.utc)
-
-    for entity in feed.entity:
-        if entity.HasField('trip_update'):
-            tu = entity.trip_update
-
-            trip_id = tu.trip.trip_id
-            route_id = tu.trip.route_id
-            direction_id = tu.trip.direction_id
-
-            arrival_delay = None
-            departure_delay = None
-            predicted_arrival_time = None
-            predicted_departure_time = None
-
-            if tu.stop_time_update:
-                for stu in tu.stop_time_update:
-                    arrival_delay = stu.arrival.delay if stu.arrival.HasField('delay') else None
-                    departure_delay = stu.departure.delay if stu.departure.HasField('delay') else None
-                    predicted_arrival_time = datetime.datetime.fromtimestamp(stu.arrival.time, tz=datetime.timezone.utc) if stu.arrival.HasField('time') and stu.arrival.time != 0 else None
-                    predicted_departure_time = datetime.datetime.fromtimestamp(stu.departure.time, tz=datetime.timezone.utc) if stu.departure.HasField('time') and stu.departure.time != 0 else None
-                    if arrival_delay is not None or departure_delay is not None or predicted_arrival_time is not None or predicted_departure_time is not None:
-                        break
-
-            extracted_data.append({
-                "ingestion_timestamp_utc": ingestion_time.isoformat(),
-                "agency": agency,
-                "line_group": line_group_passed,
-                "trip_id": trip_id,
-                "route_id": route_id,
-                "direction_id": direction_id,
-                "current_status": tu.trip.schedule_relationship if tu.trip.HasField('schedule_relationship') else None,
-                "arrival_delay_seconds": arrival_delay,
-                "departure_delay_seconds": departure_delay,
-                "predicted_arrival_time_utc": predicted_arrival_time.isoformat() if predicted_arrival_time else None,
-                "predicted_departure_time_utc": predicted_departure_time.isoformat() if predicted_departure_time else None,
-                "last_update_timestamp_feed": datetime.datetime.fromtimestamp(tu.timestamp, tz=datetime.timezone.utc).isoformat() if tu.HasField('timestamp') else None
-            })
-    return extracted_data
-
-def store_rt_data(df, conn):
-    """Stores real-time trip update data into the SQLite database."""
-    if df.empty:
+    ingestion_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    # Preallocate one list per column (at most one row per entity) and fill
+    # by index, instead of growing lists with per-row appends.
+    entities = feed.entity
+    n = len(entities)
+    trip_ids = [None] * n
+    route_ids = [None] * n
+    direction_ids = [None] * n
+    statuses = [None] * n
+    arrival_delays = [None] * n
+    departure_delays = [None] * n
+    arrival_timestamps = [None] * n
+    departure_timestamps = [None] * n
+    feed_timestamps = [None] * n
+
+    i = 0
+    for entity in entities:
+        # Skip alert/vehicle entities before touching .trip_update, so their
+        # submessages are never wrapped. (FeedEntity declares no oneof, so
+        # HasField is the cheapest presence test available here.)
+        if not entity.HasField('trip_update'):
+            continue
+
+        tu = entity.trip_update
+        trip = tu.trip
+
+        arrival_delay = None
+        departure_delay = None
+        arrival_time = None
+        departure_time = None
+
+        # Bind the arrival/departure submessages once per STU: every
+        # attribute access on a protobuf message is a descriptor call.
+        # `or None` relies on 0 being the GTFS-RT unset sentinel for
+        # times (the previous code checked != 0 for the same reason);
+        # delay keeps HasField since a 0-second delay is meaningful.
+        for stu in tu.stop_time_update:
+            arr = stu.arrival
+            dep = stu.departure
+            arrival_delay = arr.delay if arr.HasField('delay') else None
+            departure_delay = dep.delay if dep.HasField('delay') else None
+            arrival_time = arr.time or None
+            departure_time = dep.time or None
+            if arrival_delay is not None or departure_delay is not None or arrival_time is not None or departure_time is not None:
+                break
+
+        trip_ids[i] = trip.trip_id
+        route_ids[i] = trip.route_id
+        direction_ids[i] = trip.direction_id
+        statuses[i] = trip.schedule_relationship if trip.HasField('schedule_relationship') else None
+        arrival_delays[i] = arrival_delay
+        departure_delays[i] = departure_delay
+        arrival_timestamps[i] = arrival_time
+        departure_timestamps[i] = departure_time
+        feed_timestamps[i] = tu.timestamp if tu.HasField('timestamp') else None
+        i += 1
+
+    if i == 0:
+        return []
+
+    return list(zip(
+        [ingestion_iso] * i,
+        [agency] * i,
+        [line_group_passed] * i,
+        trip_ids[:i],
+        route_ids[:i],
+        direction_ids[:i],
+        statuses[:i],
+        arrival_delays[:i],
+        departure_delays[:i],
+        _isoformat_utc(arrival_timestamps[:i]),
+        _isoformat_utc(departure_timestamps[:i]),
+        _isoformat_utc(feed_timestamps[:i]),
+    ))
+
+def store_rt_data(rows, conn):
+    """Stores real-time trip update rows (RT_UPDATE_COLUMNS order) into the SQLite database."""
+    if not rows:
         print("No real-time data to store.")
         return
 
     try:
-        df.to_sql('real_time_trip_updates', conn, if_exists='append', index=False)
-        print(f"Successfully loaded {len(df)} real-time trip updates.")
-    except sqlite3.IntegrityError:
-        print(f"Warning: Duplicate entry for real-time data detected. Skipping.")
+        changes_before = conn.total_changes
+
+        # One statement for the whole batch; json_each requires TEXT, so the
+        # orjson bytes are decoded before binding. Duplicates are ignored
+        # row-by-row inside SQLite, so one republished update no longer
+        # discards the rest of the batch.
+        payload = orjson.dumps(rows).decode()
+        conn.execute(RT_INSERT_JSON_SQL, (payload,))
+
+        inserted = conn.total_changes - changes_before
+        ignored = len(rows) - inserted
+        if ignored:
+            print(f"Successfully loaded {inserted} real-time trip updates ({ignored} duplicates ignored).")
+        else:
+            print(f"Successfully loaded {inserted} real-time trip updates.")
     except sqlite3.Error as e:
         print(f"Error storing real-time data: {e}")
 
@@ -137,42 +253,75 @@ def main():
     conn = None
     try:
         conn = sqlite3.connect(DB_FILE)
+        # Manage transactions explicitly so sqlite3 doesn't inject its own BEGIN.
+        conn.isolation_level = None
+        # Bulk-insert-friendly PRAGMAs: WAL avoids journal fsyncs and lets
+        # readers run during ingest; NORMAL (not OFF) keeps durability.
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-64000;
+            PRAGMA mmap_size=268435456;
+        """)
         setup_database(conn)
 
+        # Collect every feed's rows and write them in one transaction at the
+        # end, so all ~10 feeds land in a single fsync instead of one
+        # auto-commit per feed.
+        all_rows = []
+
+        # All feeds are pure network I/O, so fetch them concurrently and
+        # process each one on the main thread as soon as its bytes arrive.
+        futures = {}
+        with ThreadPoolExecutor(max_workers=len(RT_FEED_CONFIG)) as executor:
+            for config in RT_FEED_CONFIG:
+                # ** THE FIX IS HERE **
+                # Use .get() for safer dictionary access and check for essential keys
+                agency = config.get('agency')
+                feed_url = config.get('url')
+                feed_type = config.get('feed_type')
+
+                if not all([agency, feed_url, feed_type]):
+                    print(f"Warning: Skipping invalid or incomplete config entry: {config}")
+                    continue # Move to the next item in the loop
+
+                line_group = config.get('line_group')
+
+                print(f"Fetching {feed_type} data for {agency} ({line_group if line_group else 'all lines'})...")
+
+                headers = {}
+                if agency == "MTA" and MTA_API_KEY:
+                    headers['x-api-key'] = MTA_API_KEY
+                elif agency == "MTA":
+                     print(f"Warning: MTA_API_KEY not found. Proceeding without it.")
+
+                future = executor.submit(fetch_and_parse_gtfs_rt, feed_url, headers=headers)
+                futures[future] = config
+
+            for future in as_completed(futures):
+                config = futures[future]
+                agency = config.get('agency')
+                feed_type = config.get('feed_type')
+                line_group = config.get('line_group')
+
+                feed_message = future.result()
+
+                if feed_message and feed_type == "TripUpdate":
+                    extracted_updates = process_trip_updates(feed_message, agency, line_group_passed=line_group)
+                    if extracted_updates:
+                        all_rows.extend(extracted_updates)
+                    else:
+                        print(f"No trip update entities found in {agency} ({line_group}) feed.")
+                elif not feed_message:
+                    print(f"Failed to fetch/parse {agency} ({line_group}) feed.")
+
         total_records_fetched = 0
-        for config in RT_FEED_CONFIG:
-            # ** THE FIX IS HERE **
-            # Use .get() for safer dictionary access and check for essential keys
-            agency = config.get('agency')
-            feed_url = config.get('url')
-            feed_type = config.get('feed_type')
-
-            if not all([agency, feed_url, feed_type]):
-                print(f"Warning: Skipping invalid or incomplete config entry: {config}")
-                continue # Move to the next item in the loop
-
-            line_group = config.get('line_group')
-
-            print(f"\nFetching {feed_type} data for {agency} ({line_group if line_group else 'all lines'})...")
-
-            headers = {}
-            if agency == "MTA" and MTA_API_KEY:
-                headers['x-api-key'] = MTA_API_KEY
-            elif agency == "MTA":
-                 print(f"Warning: MTA_API_KEY not found. Proceeding without it.")
-
-            feed_message = fetch_and_parse_gtfs_rt(feed_url, headers=headers)
-
-            if feed_message and feed_type == "TripUpdate":
-                extracted_updates = process_trip_updates(feed_message, agency, line_group_passed=line_group)
-                if extracted_updates:
-                    df_updates = pd.DataFrame(extracted_updates)
-                    store_rt_data(df_updates, conn)
-                    total_records_fetched += len(df_updates)
-                else:
-                    print(f"No trip update entities found in {agency} ({line_group}) feed.")
-            elif not feed_message:
-                print(f"Failed to fetch/parse {agency} ({line_group}) feed.")
+        if all_rows:
+            conn.execute("BEGIN")
+            store_rt_data(all_rows, conn)
+            conn.execute("COMMIT")
+            total_records_fetched = len(all_rows)
 
         print(f"\n--- Real-time GTFS Data Pipeline Finished. Total trip updates fetched: {total_records_fetched} ---")
 
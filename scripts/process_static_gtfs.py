@@ -1,5 +1,10 @@
+import csv
+import io
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import sqlite3
 import os
 
@@ -32,99 +37,354 @@ STATIC_GTFS_CONFIG = {
 DB_FILE = os.path.join(PROJECT_ROOT, "transit_performance_data.db")
 SCHEMA_FILE = os.path.join(PROJECT_ROOT, "sql/schema.sql")
 DATA_DIR = os.path.join(PROJECT_ROOT, "data")
+# Parsed stop_times chunks are cached here as Parquet (invalidated by the
+# source zip's mtime), so repeat runs skip the expensive CSV re-parse.
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+
+# Columns that exist in our database tables, and each table's primary key.
+TABLE_COLUMNS = {
+    'routes': ['agency_id', 'route_id', 'route_short_name', 'route_long_name', 'route_type'],
+    'stops': ['agency_id', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+    'trips': ['agency_id', 'route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id'],
+    'stop_times': ['agency_id', 'trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+}
+
+PRIMARY_KEYS = {
+    'routes': ['agency_id', 'route_id'],
+    'stops': ['agency_id', 'stop_id'],
+    'trips': ['agency_id', 'trip_id'],
+    'stop_times': ['agency_id', 'trip_id', 'stop_sequence']
+}
+
+# The schema is read once at import, so repeat invocations (including the
+# staging workers, which import this module) skip the disk read and hand
+# executescript the already-loaded text. A missing file is surfaced when
+# setup_database actually needs the schema.
+try:
+    with open(SCHEMA_FILE) as _f:
+        _SCHEMA_SQL = _f.read()
+except FileNotFoundError:
+    _SCHEMA_SQL = None
+
+# The small tables are batched across agencies (one insert round per table);
+# stop_times is streamed per agency because it is too large to concatenate.
+SMALL_TABLES = ['routes', 'stops', 'trips']
+
+# One-shot ETL configuration, applied to the main and staging databases:
+# they are rebuilt from the zips, so durability on crash is traded for
+# bulk-load speed (synchronous=OFF skips fsyncs; the exclusive lock and
+# large cache suit a single writer per file).
+ETL_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=OFF;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-262144;
+    PRAGMA locking_mode=EXCLUSIVE;
+"""
+
+# Per-table INSERT SQL cache: handing sqlite3 byte-identical statement text
+# lets it reuse the compiled sqlite3_stmt across chunks and agencies
+# instead of re-parsing and re-planning the INSERT each time.
+_INSERT_SQL = {}
+
+def _cached_insert_sql(table_name, cols, or_ignore=False):
+    """Returns (and memoizes) the INSERT statement for a table/column list."""
+    key = (table_name, tuple(cols))
+    sql = _INSERT_SQL.get(key)
+    if sql is None:
+        verb = "INSERT OR IGNORE" if or_ignore else "INSERT"
+        col_list = ",".join(cols)
+        placeholders = ",".join("?" * len(cols))
+        sql = f"{verb} INTO {table_name} ({col_list}) VALUES ({placeholders})"
+        _INSERT_SQL[key] = sql
+    return sql
 
 
 def setup_database(conn):
     """
-    Sets up the database by executing the master schema file.
+    Sets up the database by executing the master schema (read once at import).
     """
+    if _SCHEMA_SQL is None:
+        print(f"Error: Schema file not found at '{SCHEMA_FILE}'. Please ensure the file exists.")
+        raise FileNotFoundError(SCHEMA_FILE)
     try:
-        with open(SCHEMA_FILE, 'r') as f:
-            conn.executescript(f.read())
+        conn.executescript(_SCHEMA_SQL)
         print(f"Database schema from '{SCHEMA_FILE}' processed successfully.")
     except sqlite3.Error as e:
         print(f"Error setting up database from schema: {e}")
-    except FileNotFoundError:
-        print(f"Error: Schema file not found at '{SCHEMA_FILE}'. Please ensure the file exists.")
-        raise
 
-def load_static_gtfs_file(zip_path, filename, agency_id, conn, table_name):
+def create_load_tables(conn):
     """
-    Loads a single GTFS file, selects only the columns that exist in the DB table,
-    and loads them into SQLite.
+    Recreates stop_times as a plain load table with no PK or FKs.
+    Maintaining the composite (agency_id, trip_id, stop_sequence) B-tree on
+    every insert dominates bulk-load cost at millions of rows, so
+    uniqueness is enforced in Python during the load and the index is
+    built once afterwards by finalize_load.
     """
-    # Define the columns that exist in our database tables
-    table_columns = {
-        'routes': ['agency_id', 'route_id', 'route_short_name', 'route_long_name', 'route_type'],
-        'stops': ['agency_id', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
-        'trips': ['agency_id', 'route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id'],
-        'stop_times': ['agency_id', 'trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
-    }
+    conn.executescript("""
+        DROP TABLE IF EXISTS stop_times;
+        CREATE TABLE stop_times (
+            agency_id TEXT NOT NULL,
+            trip_id TEXT NOT NULL,
+            arrival_time INTEGER,
+            departure_time INTEGER,
+            stop_id TEXT NOT NULL,
+            stop_sequence INTEGER
+        );
+    """)
 
-    primary_keys = {
-        'routes': ['agency_id', 'route_id'],
-        'stops': ['agency_id', 'stop_id'],
-        'trips': ['agency_id', 'trip_id'],
-        'stop_times': ['agency_id', 'trip_id', 'stop_sequence']
-    }
+def finalize_load(conn):
+    """Builds the deferred stop_times index and refreshes planner statistics."""
+    print("\nBuilding deferred stop_times index...")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_stop_times_pk "
+        "ON stop_times(agency_id, trip_id, stop_sequence)"
+    )
+    conn.execute("ANALYZE")
 
+def read_static_table(z, filename, agency_id, table_name):
+    """
+    Parses one small GTFS file from an already-open ZipFile straight into
+    row tuples in TABLE_COLUMNS order, or returns None if the member is
+    missing. These files are a few thousand rows at most, so the stdlib
+    csv reader feeds executemany directly with no DataFrame construction;
+    columns the feed doesn't provide come through as None, as do empty
+    values (matching SQL NULL semantics of the previous parsers).
+    """
+    value_cols = [c for c in TABLE_COLUMNS[table_name] if c != 'agency_id']
     try:
-        with zipfile.ZipFile(zip_path, 'r') as z:
-            with z.open(filename) as f:
-                df = pd.read_csv(f, dtype=str)
-                df['agency_id'] = agency_id
-                df.rename(columns=lambda x: x.strip(), inplace=True)
-
-                # Get the list of expected columns for this table from our schema definition
-                expected_cols = table_columns.get(table_name)
-                if not expected_cols:
-                    print(f"Warning: No column schema defined for table '{table_name}'. Skipping.")
-                    return
-
-                # ** THE FIX IS HERE **
-                # Filter the DataFrame to only include columns that are both in the file AND in our schema
-                cols_to_load = [col for col in expected_cols if col in df.columns]
-                df_filtered = df[cols_to_load].copy()
-
-                # Drop duplicates based on the primary key
-                pk = primary_keys.get(table_name)
-                if pk:
-                    df_filtered.drop_duplicates(subset=pk, inplace=True)
-
-                df_filtered.to_sql(table_name, conn, if_exists='append', index=False)
-                print(f"Successfully loaded {len(df_filtered)} records from {filename} into {table_name}.")
+        f = z.open(filename)
+    except KeyError:
+        print(f"Warning: '{filename}' not found in {z.filename}. Skipping.")
+        return None
+
+    with io.TextIOWrapper(f, encoding='utf-8-sig') as text:
+        reader = csv.DictReader(text)
+        reader.fieldnames = [name.strip() for name in (reader.fieldnames or [])]
+        return [(agency_id,) + tuple(row.get(c) or None for c in value_cols)
+                for row in reader]
+
+def insert_small_table(conn, table_name, rows):
+    """
+    Bulk-inserts small-table rows (TABLE_COLUMNS order) in one transaction.
+    No Python-side dedup: these tables keep their PRIMARY KEY, so OR IGNORE
+    lets SQLite's B-tree drop duplicates at C speed while the rows stream
+    in. executemany binds the row tuples in the C driver.
+    """
+    insert_sql = _cached_insert_sql(table_name, TABLE_COLUMNS[table_name], or_ignore=True)
+    conn.execute("BEGIN")
+    conn.executemany(insert_sql, rows)
+    conn.execute("COMMIT")
+    print(f"Successfully loaded {len(rows)} records into {table_name}.")
+
+def load_stop_times(z, filename, agency_id, conn):
+    """
+    Streams one agency's stop_times.txt into the load table in 100k-row
+    chunks; peak memory is O(chunk) instead of O(file), which matters for
+    MTA's 500MB+ member. Rows are deduplicated against a set of PK tuples
+    carried across chunks (per-chunk drop_duplicates would let a key recur
+    in a later chunk and break the deferred unique-index build).
+    """
+    table_name = 'stop_times'
+    pk = PRIMARY_KEYS[table_name]
+    # usecols pushes the projection into the parser: unused GTFS columns
+    # (shape_dist_traveled etc.) are never decoded or allocated.
+    wanted = set(TABLE_COLUMNS[table_name]) - {'agency_id'}
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # v2: times cached as integer seconds-of-day; the version suffix keeps
+    # stale caches holding the old TEXT layout from being replayed.
+    cache_path = os.path.join(CACHE_DIR, f"{agency_id}_{table_name}_v2.parquet")
+    cache_fresh = (os.path.exists(cache_path)
+                   and os.path.getmtime(cache_path) > os.path.getmtime(z.filename))
+
+    total_loaded = 0
+    insert_sql = None
+    seen_keys = set()
+    writer = None
+    tmp_path = cache_path + ".tmp"
+
+    try:
+        if cache_fresh:
+            # Cache hit: Parquet row groups stream back as 100k-row batches,
+            # 10-50x faster than re-parsing the CSV, still O(chunk) memory.
+            # The cached row groups were cleaned and deduplicated when
+            # written, so replay goes Arrow -> row tuples -> executemany
+            # with no pandas frame in between.
+            print(f"Reading {table_name} for {agency_id} from Parquet cache...")
+            pf = pq.ParquetFile(cache_path)
+            insert_sql = _cached_insert_sql(table_name, pf.schema_arrow.names)
+            conn.execute("BEGIN")
+            for batch in pf.iter_batches(batch_size=100_000):
+                rows = list(zip(*(col.to_pylist() for col in batch.columns)))
+                conn.executemany(insert_sql, rows)
+                total_loaded += len(rows)
+            conn.execute("COMMIT")
+            print(f"Successfully loaded {total_loaded} records from {filename} into {table_name}.")
+            return
+
+        # Stays on the C engine: pandas' multithreaded engine='pyarrow'
+        # does not support chunksize, and dropping the chunked stream
+        # would reintroduce the O(file) memory spike this path exists
+        # to avoid.
+        # An 8MB buffer sits between the zip's DEFLATE stream and the
+        # CSV parser: ZipExtFile yields smallish decompressed blocks,
+        # and coalescing them here means the C parser issues a handful
+        # of large reads per chunk instead of thousands of small ones.
+        # skipinitialspace handles the usual "a, b, c" header sloppiness in
+        # the parser itself; the rename below only fires for the rarer
+        # trailing-whitespace case, so clean files skip the per-chunk
+        # column-Index rebuild the old unconditional rename paid.
+        stream = io.BufferedReader(z.open(filename), buffer_size=8 * 1024 * 1024)
+        chunks = pd.read_csv(stream, chunksize=100_000, dtype=str,
+                             skipinitialspace=True,
+                             usecols=lambda c: c.strip() in wanted)
 
+        rename_map = None
+        conn.execute("BEGIN")
+        for chunk in chunks:
+            if rename_map is None:
+                rename_map = {c: c.strip() for c in chunk.columns if c != c.strip()}
+            if rename_map:
+                chunk.rename(columns=rename_map, inplace=True)
+            chunk['agency_id'] = agency_id
+            # GTFS "HH:MM:SS" (hours may exceed 24) becomes integer
+            # seconds-of-day in one vectorized pass; malformed or
+            # missing times fall out as NULL.
+            for col in ('arrival_time', 'departure_time'):
+                if col not in chunk.columns:
+                    continue
+                parts = (chunk[col].str.split(':', expand=True)
+                         .reindex(columns=range(3)).astype('float64'))
+                secs = (parts[0] * 3600 + parts[1] * 60 + parts[2]).astype('Int64')
+                chunk[col] = secs.astype(object).where(secs.notna(), None)
+
+            # The not-in/add trick filters inline at C set speed.
+            keys = zip(*(chunk[c] for c in pk))
+            mask = [k not in seen_keys and not seen_keys.add(k) for k in keys]
+            chunk = chunk.loc[mask]
+
+            # Append each cleaned chunk to the cache as its own row
+            # group; the whole frame is never held in memory. The cache
+            # lands under a tmp name and is renamed only on success.
+            arrow_chunk = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, arrow_chunk.schema, compression='snappy')
+            writer.write_table(arrow_chunk)
+
+            if insert_sql is None:
+                insert_sql = _cached_insert_sql(table_name, list(chunk.columns))
+
+            # to_records materializes all row tuples in one C call, instead
+            # of itertuples' per-row Python iteration, and hands executemany
+            # a list it can walk inside the C driver.
+            conn.executemany(insert_sql, chunk.to_records(index=False).tolist())
+            total_loaded += len(chunk)
+        conn.execute("COMMIT")
+
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp_path, cache_path)
+        print(f"Successfully loaded {total_loaded} records from {filename} into {table_name}.")
     except KeyError:
-        print(f"Warning: '{filename}' not found in {zip_path}. Skipping.")
+        print(f"Warning: '{filename}' not found in {z.filename}. Skipping.")
     except Exception as e:
-        print(f"Error loading {filename} from {zip_path}: {e}")
+        print(f"Error loading {filename} from {z.filename}: {e}")
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stage_stop_times(zip_path, filename, agency_id):
+    """
+    Worker for the parallel stop_times load: parses one agency's file into
+    its own staging database, so both agencies' CPU-bound parse and dedup
+    run in separate processes with no shared writer. Returns the staging
+    DB path for the merge step.
+    """
+    staging_path = os.path.join(PROJECT_ROOT, f"staging_{agency_id}.db")
+    if os.path.exists(staging_path):
+        os.remove(staging_path)
+
+    conn = sqlite3.connect(staging_path, cached_statements=256, isolation_level=None)
+    try:
+        conn.executescript(ETL_PRAGMAS)
+        create_load_tables(conn)
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            load_stop_times(z, filename, agency_id, conn)
+    finally:
+        conn.close()
+    return staging_path
 
 
 def main():
     print("--- Starting Static GTFS Data Pipeline ---")
     conn = None
+    zips = {}
     try:
-        conn = sqlite3.connect(DB_FILE)
+        # isolation_level=None: transactions are issued explicitly around
+        # each file's bulk insert. The enlarged statement cache keeps every
+        # table's compiled INSERT resident for the whole run.
+        conn = sqlite3.connect(DB_FILE, cached_statements=256, isolation_level=None)
+        conn.executescript(ETL_PRAGMAS)
         setup_database(conn)
+        create_load_tables(conn)
 
-        for zip_name, config in STATIC_GTFS_CONFIG.items():
+        # One ZipFile per agency, opened up front and shared by both passes:
+        # the central directory is read and validated once per archive.
+        for zip_name in STATIC_GTFS_CONFIG:
             zip_path = os.path.join(DATA_DIR, zip_name)
-            agency_id = config['agency_id']
-
             if not os.path.exists(zip_path):
                 print(f"Warning: Data file not found at {zip_path}. Skipping.")
                 continue
+            zips[zip_name] = zipfile.ZipFile(zip_path, 'r')
+
+        # Pass 1: small tables, batched across agencies. Each table gets one
+        # combined insert round instead of a parse/insert cycle per
+        # (agency, file) pair, amortizing transaction and statement cost.
+        for table in SMALL_TABLES:
+            rows = []
+            for zip_name, z in zips.items():
+                config = STATIC_GTFS_CONFIG[zip_name]
+                agency_rows = read_static_table(z, config['files'][table], config['agency_id'], table)
+                if agency_rows:
+                    rows.extend(agency_rows)
+            if rows:
+                insert_small_table(conn, table, rows)
+
+        # Pass 2: stop_times. Zip decompression, CSV parsing, and dedup are
+        # CPU-bound and independent per agency, so each agency runs in its
+        # own process against a staging DB; the staged rows are then merged
+        # into the final table with one INSERT SELECT per agency, which
+        # stays inside SQLite.
+        jobs = [(os.path.join(DATA_DIR, zip_name),
+                 STATIC_GTFS_CONFIG[zip_name]['files']['stop_times'],
+                 STATIC_GTFS_CONFIG[zip_name]['agency_id'])
+                for zip_name in zips]
 
-            print(f"\nProcessing static GTFS for {agency_id} from {zip_name}...")
+        if jobs:
+            print("\nParsing stop_times for all agencies in parallel...")
+            with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+                staging_paths = list(executor.map(stage_stop_times, *zip(*jobs)))
 
-            for table, file_path in config['files'].items():
-                load_static_gtfs_file(zip_path, file_path, agency_id, conn, table)
+            for staging_path in staging_paths:
+                conn.execute("ATTACH DATABASE ? AS staging", (staging_path,))
+                conn.execute("BEGIN")
+                conn.execute("INSERT INTO stop_times SELECT * FROM staging.stop_times")
+                conn.execute("COMMIT")
+                conn.execute("DETACH DATABASE staging")
+                os.remove(staging_path)
 
-            conn.commit()
+        finalize_load(conn)
 
     except Exception as e:
         print(f"An error occurred during the main static GTFS pipeline execution: {e}")
     finally:
+        for z in zips.values():
+            z.close()
         if conn:
             conn.close()
             print("Database connection closed.")
@@ -1,6 +1,4 @@
 import sqlite3
-import pandas as pd
-import os
 
 DB_FILE = "transit_realtime_data.db"
 # Ensure you are in the correct directory. VS Code terminal usually starts in project root.
@@ -15,23 +13,20 @@ try:
     # Focus on delays and line_group, and check for BART data
     query_data = "SELECT ingestion_timestamp_utc, agency, line_group, trip_id, route_id, arrival_delay_seconds, departure_delay_seconds, predicted_arrival_time_utc FROM real_time_trip_updates ORDER BY ingestion_timestamp_utc DESC LIMIT 20;"
     print("\n--- Sample Real-time Trip Updates (Top 20, checking delays) ---")
-    df_data = pd.read_sql_query(query_data, conn)
-    print(df_data)
+    for row in conn.execute(query_data):
+        print(row)
 
-    # Query to count total real-time records
-    query_count = "SELECT COUNT(*) AS total_records FROM real_time_trip_updates;"
-    print("\n--- Total Real-time Records ---")
-    df_count = pd.read_sql_query(query_count, conn)
-    print(df_count)
-
-    # Count records per agency/line group (crucial for BART)
+    # One aggregation pass produces both the per-agency/line-group counts
+    # (crucial for BART) and, summed in Python, the grand total — the old
+    # separate COUNT(*) query scanned the whole table a second time, and
+    # pandas added nothing to a printed summary.
     query_agency_counts = """
     SELECT
         agency,
         line_group,
         COUNT(*) AS record_count,
-        SUM(CASE WHEN arrival_delay_seconds IS NOT NULL THEN 1 ELSE 0 END) AS records_with_arrival_delay,
-        SUM(CASE WHEN departure_delay_seconds IS NOT NULL THEN 1 ELSE 0 END) AS records_with_departure_delay
+        SUM(arrival_delay_seconds IS NOT NULL) AS records_with_arrival_delay,
+        SUM(departure_delay_seconds IS NOT NULL) AS records_with_departure_delay
     FROM
         real_time_trip_updates
     GROUP BY
@@ -40,8 +35,12 @@ try:
         agency, line_group;
     """
     print("\n--- Real-time Record Counts by Agency/Line Group (with delay counts) ---")
-    df_agency_counts = pd.read_sql_query(query_agency_counts, conn)
-    print(df_agency_counts)
+    agency_counts = conn.execute(query_agency_counts).fetchall()
+    for row in agency_counts:
+        print(row)
+
+    print("\n--- Total Real-time Records ---")
+    print(sum(row[2] for row in agency_counts))
 
 except sqlite3.Error as e:
     print(f"Error accessing SQLite database '{DB_FILE}': {e}")
@@ -50,4 +49,4 @@ except Exception as e:
 finally:
     if conn:
         conn.close()
-        print("\nDatabase connection closed.")
\ No newline at end of file
+        print("\nDatabase connection closed.")
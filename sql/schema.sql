@@ -18,6 +18,22 @@ CREATE TABLE IF NOT EXISTS real_time_trip_updates (
     PRIMARY KEY (ingestion_timestamp_utc, agency, trip_id)
 );
 
+-- Supports "latest update per trip" lookups in the analysis script: both
+-- the MAX(ingestion_timestamp_utc) per trip and the matching-row lookup
+-- stream in index order instead of sorting the whole table.
+CREATE INDEX IF NOT EXISTS idx_trip_ingest
+    ON real_time_trip_updates(trip_id, ingestion_timestamp_utc DESC);
+
+-- Covering index for the verification script's per-agency/line-group
+-- aggregation: the delay columns ride along so the query is answered by
+-- an index-only scan with no heap lookups.
+CREATE INDEX IF NOT EXISTS idx_rttu_agency_lg
+    ON real_time_trip_updates(agency, line_group, arrival_delay_seconds, departure_delay_seconds);
+
+-- Index-backed ordering for the "latest 20 updates" sample query.
+CREATE INDEX IF NOT EXISTS idx_rttu_ingestion
+    ON real_time_trip_updates(ingestion_timestamp_utc DESC);
+
 -- =================================================================
 -- Schema for Static GTFS Data
 -- =================================================================
@@ -54,8 +70,11 @@ CREATE TABLE IF NOT EXISTS trips (
 CREATE TABLE IF NOT EXISTS stop_times (
     agency_id TEXT NOT NULL,
     trip_id TEXT NOT NULL,
-    arrival_time TEXT,
-    departure_time TEXT,
+    -- Seconds since midnight (GTFS times can exceed 24:00:00 for
+    -- after-midnight service, so this is not a clock time). Integers
+    -- compare and index far cheaper than "HH:MM:SS" text.
+    arrival_time INTEGER,
+    departure_time INTEGER,
     stop_id TEXT NOT NULL,
     stop_sequence INTEGER,
     PRIMARY KEY (agency_id, trip_id, stop_sequence),